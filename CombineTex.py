@@ -1,27 +1,165 @@
 import sys
-import glob
 import os
 import re
+import functools
+import concurrent.futures
+
+# Matches \input{...} and \include{...} in raw bytes and captures the file name
+INCLUDE_BYTES_RE = re.compile(rb'\\(?:input|include)\{([^}\n]+)\}')
+
+# Matches any of the commands classify looks for, so a file can be checked for all of them in one pass over its bytes
+CLASSIFY_MARKER_RE = re.compile(rb'\\(?:input\{|include\{|begin\{document\}|documentclass)')
+
+def strip_comments(text):
+    """
+    Removes LaTeX comments from text, one line at a time. text can be a str or raw bytes,
+    since all the markers involved are ASCII.
+    Everything from the first unescaped % to the end of the line is dropped,
+    while the line break itself is kept.
+    """
+    if isinstance(text, bytes):
+        percent, backslash, newline = b'%', b'\\', b'\n'
+    else:
+        percent, backslash, newline = '%', '\\', '\n'
+    if percent not in text:
+        return text
+
+    out = []
+    for line in text.splitlines(keepends=True):
+        i = line.find(percent)
+        while i != -1:
+            # A % is escaped if an odd number of backslashes precede it (\% is a percent sign, \\% a comment)
+            backslashes = 0
+            while i - backslashes > 0 and line[i - backslashes - 1:i - backslashes] == backslash:
+                backslashes += 1
+            if backslashes % 2 == 0:
+                break
+            i = line.find(percent, i + 1)
+        if i == -1:
+            out.append(line)
+        else:
+            out.append(line[:i])
+            if line.endswith(newline):
+                out.append(newline)
+    return text[:0].join(out)
+
+
+# Names of the entries of every directory looked at so far, keyed by directory path
+_dircache = {}
+
+
+def _dir_has(dirpath, name):
+    """
+    Checks whether a directory, given as an absolute path, contains an entry with the given name.
+    Each directory is listed once with os.scandir instead of calling os.path.exists per include.
+    Names missing from the listing are still checked with os.path.exists: normcase only ignores case on Windows,
+    while other case-insensitive filesystems, like the default one on macOS, find the file under a differently cased name.
+    """
+    key = os.path.normcase(dirpath)
+    if key not in _dircache:
+        try:
+            with os.scandir(dirpath) as entries:
+                _dircache[key] = {os.path.normcase(entry.name) for entry in entries}
+        except OSError:
+            _dircache[key] = set()
+    if os.path.normcase(name) in _dircache[key]:
+        return True
+    return os.path.exists(os.path.join(dirpath, name))
+
+
+@functools.lru_cache(maxsize=None)
+def _read_tex(abs_path):
+    """
+    Returns the raw bytes of a LaTeX file, given as an absolute path.
+    Files are read from disk once per process, so finding the main file and combining it share the same reads.
+    """
+    with open(abs_path, 'rb') as file:
+        return file.read()
+
+
+def _read_all(abs_paths):
+    """
+    Reads several LaTeX files at once in a thread pool, so the disk reads overlap.
+    Returns, in order, the raw bytes of every file or the exception raised while reading it.
+    """
+    def read(abs_path):
+        try:
+            return _read_tex(abs_path)
+        except Exception as e:
+            return e
+
+    if len(abs_paths) < 2:
+        return [read(abs_path) for abs_path in abs_paths]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(abs_paths))) as executor:
+        return list(executor.map(read, abs_paths))
+
+
+def _resolve_include(name, base_dir):
+    """
+    Turns the argument of an \\input or \\include command into an absolute file path, adding .tex if needed.
+    base_dir must already be absolute, so no further path lookups are needed per include.
+    """
+    include_file = name.strip()
+    # Ensure the file has a .tex extension if it's not provided
+    if not include_file.endswith('.tex'):
+        include_file += '.tex'
+    return os.path.normpath(os.path.join(base_dir, include_file))
+
+
+def classify(tex_files):
+    """
+    Scans every LaTeX file once and records whether it contains \\begin{document} or \\documentclass,
+    together with the files it includes.
+    Returns a {absolute path: info} dict and the set of absolute paths included by other files.
+    The files are scanned as raw bytes, only the names of the included files are decoded.
+    Files that contain none of the commands are not even stripped of comments.
+    """
+    base_dir = os.getcwd()  # Includes are resolved relative to the folder LaTeX is run from
+    info = {}
+    included = set()
+
+    def add(tex_file, tex_content):
+        names = [name.decode('utf-8', errors='replace') for name in INCLUDE_BYTES_RE.findall(tex_content)]
+        has_begin = b'\\begin{document}' in tex_content
+        has_class = b'\\documentclass' in tex_content
+        includes = [_resolve_include(name, base_dir) for name in names]
+        info[tex_file] = {
+            'has_begin': has_begin,
+            'has_class': has_class,
+            'includes': includes,
+        }
+        included.update(includes)
+
+    abs_paths = [os.path.abspath(tex_file) for tex_file in tex_files]
+    for tex_file, abs_path, raw in zip(tex_files, abs_paths, _read_all(abs_paths)):
+        if isinstance(raw, Exception):
+            print(f"Error reading {tex_file}: {raw}")
+            continue
+        if CLASSIFY_MARKER_RE.search(raw):
+            add(abs_path, strip_comments(raw))
+        else:
+            # Nothing to find in this file, so it is not stripped of comments
+            info[abs_path] = {'has_begin': False, 'has_class': False, 'includes': []}
+    return info, included
+
 
 def find_main_tex_file(tex_files):
     """
     Identifies the main LaTeX file that contains \begin{document}.
+    Files included by other files are only considered if no other candidate is found,
+    and if no file contains \\begin{document}, the first file with a \\documentclass is used instead.
     """
-    for tex_file in tex_files:
-        try:
-            with open(tex_file, 'r', encoding='utf-8', errors='replace') as file:
-                tex_content = ""
-                for line in file:
-                    # Strip leading/trailing spaces and check if line starts with %
-                    if line.strip().startswith('%'):
-                        continue  # Skip lines starting with %
-                    tex_content += line  # Append non-comment lines
-                # Use a raw string to avoid escape sequence errors with LaTeX commands
-                if re.search(r'\\begin{document}', tex_content):  # Raw string for backslashes
+    info, included = classify(tex_files)
+
+    abs_paths = {tex_file: os.path.abspath(tex_file) for tex_file in tex_files}
+    readable = [tex_file for tex_file in tex_files if abs_paths[tex_file] in info]
+    roots = [tex_file for tex_file in readable if abs_paths[tex_file] not in included]
+    for candidates in (roots, readable):
+        for key in ('has_begin', 'has_class'):
+            for tex_file in candidates:
+                if info[abs_paths[tex_file]][key]:
                     print(f"Main LaTeX file found: {tex_file}")
                     return tex_file
-        except Exception as e:
-            print(f"Error reading {tex_file}: {e}")
     return None
 
 
@@ -30,60 +168,83 @@ def combine_tex_files(main_file, output_file):
     Combines the main LaTeX file and its included files into a single LaTeX file,
     replacing \input and \include lines directly with the contents of the included files.
     """
-    def read_file_with_includes(tex_file, already_processed=None):
-        if already_processed is None:
-            already_processed = set()
+    chunks = []  # Raw bytes of the combined file, in output order
+    # Range of chunks holding the expanded content of every file read so far, keyed by absolute path,
+    # so that a file included several times is read from disk only once
+    expanded_cache = {}
+    stack = []  # Files being expanded: [absolute path, lines, next line index, first chunk index]
+    in_progress = set()
 
-        if tex_file in already_processed:
-            return ""
+    base_dir = os.getcwd()  # Includes are resolved relative to the folder LaTeX is run from
 
-        try:
-            combined_content = ""
-            with open(tex_file, 'r', encoding='utf-8', errors='replace') as file:
-                for line in file:
-                    if line.strip().startswith('%'):
-                        continue  # Skip comment lines
-
-                    # Check if the line contains \input or \include
-                    match = re.search(r'\\(?:input|include)\{(.+?)\}', line)
-                    if match:
-                        # Extract the filename from the \input or \include command
-                        include_file = match.group(1).strip()
-
-                        # Ensure the file has a .tex extension if it's not provided
-                        if not include_file.endswith('.tex'):
-                            include_file += '.tex'
-
-                        if os.path.exists(include_file):
-                            print(f"Including file: {include_file}")
-                            # Recursively read the included file and add its content
-                            included_content = read_file_with_includes(include_file, already_processed)
-                            combined_content += included_content  # Insert the content of the included file
-                        else:
-                            print(f"File {include_file} not found!")
-                    else:
-                        combined_content += line  # Add the line if it's not \input or \include
-
-            # Mark this file as processed to avoid recursion
-            already_processed.add(tex_file)
-
-            return combined_content
+    def start_file(abs_path):
+        if abs_path in expanded_cache:
+            start, end = expanded_cache[abs_path]
+            chunks.extend(chunks[start:end])  # Reuses the same bytes objects, nothing is copied
+            return
+        if abs_path in in_progress:
+            return  # Include cycle, the file is already being expanded
 
+        try:
+            # Files are kept as bytes, only lines that may hold an include are decoded
+            original = _read_tex(abs_path)
         except Exception as e:
-            print(f"Error reading {tex_file}: {e}")
-            return ""
+            print(f"Error reading {abs_path}: {e}")
+            expanded_cache[abs_path] = (len(chunks), len(chunks))
+            return
 
-    # Combine the content from the main file and any included files
-    combined_tex_content = read_file_with_includes(main_file)
+        lines = original.splitlines(keepends=True)
+        if b'\\input{' not in original and b'\\include{' not in original:
+            # Fast path for leaf files: nothing to expand, only drop the comment lines
+            chunks.append(b''.join(line for line in lines if not line.strip().startswith(b'%')))
+            expanded_cache[abs_path] = (len(chunks) - 1, len(chunks))
+            return
 
-    # Write the combined content to the output file
-    with open(output_file, 'w', encoding='utf-8') as out_file:
-        out_file.write(combined_tex_content)
+        in_progress.add(abs_path)
+        stack.append([abs_path, lines, 0, len(chunks)])
 
-    print(f"Combined LaTeX file created: {output_file}")
+    # Expand the main file with an explicit stack instead of recursion, so deep \input trees
+    # don't hit the recursion limit
+    start_file(os.path.abspath(main_file))
+    while stack:
+        frame = stack[-1]
+        abs_path, lines, index, start = frame
+        if index == len(lines):
+            stack.pop()
+            in_progress.discard(abs_path)
+            expanded_cache[abs_path] = (start, len(chunks))
+            continue
+        frame[2] = index + 1
 
-# Example usage:
-combine_tex_files('main.tex', 'combined_output.tex')
+        line = lines[index]
+        if line.strip().startswith(b'%'):
+            continue  # Skip comment lines
+        if b'\\input{' not in line and b'\\include{' not in line:
+            chunks.append(line)
+            continue
+
+        # Check if the line contains \input or \include outside of a comment, only the file name is decoded
+        match = INCLUDE_BYTES_RE.search(strip_comments(line))
+        if match:
+            # Extract the filename from the \input or \include command
+            include_name = match.group(1).decode('utf-8', errors='replace').strip()
+            include_file = _resolve_include(include_name, base_dir)
+
+            if _dir_has(os.path.dirname(include_file), os.path.basename(include_file)):
+                print(f"Including file: {include_name}")
+                # Insert the content of the included file in place of this line
+                start_file(include_file)
+            else:
+                print(f"File {include_name} not found!")
+        else:
+            chunks.append(line)  # Add the line if it's not \input or \include
+
+    # Write the combined content to the output file, keeping the bytes of the input files as they are.
+    # The chunks are streamed through a large buffer instead of being joined into one more copy first.
+    with open(output_file, 'wb', buffering=1 << 20) as out_file:
+        out_file.writelines(chunks)
+
+    print(f"Combined LaTeX file created: {output_file}")
 
 if __name__ == "__main__":
     # Get the input arguments from the console
@@ -92,7 +253,9 @@ if __name__ == "__main__":
 
     # Find all .tex files in the current folder if the input file is not provided
     if tex_file is None:
-        tex_files = glob.glob('*.tex')
+        # A single directory listing, with the same hidden file rule as glob
+        tex_files = sorted(entry.name for entry in os.scandir('.')
+                           if entry.name.endswith('.tex') and not entry.name.startswith('.') and entry.is_file())
         print(f"Found {len(tex_files)} .tex files in the current directory.")
     else:
         tex_files = [tex_file]
@@ -1,201 +1,937 @@
 import re
 import os
-import glob
 import subprocess
-import threading
 import sys
+import shutil
+import hashlib
+import json
+import tempfile
+import mmap
+import functools
+import itertools
+import concurrent.futures
 
-def find_equations(tex_file):
+# Folder of compiled equations shared by all runs, keyed by equation_key
+CACHE_DIR = '.tex2svg_cache'
+
+# Version of the equations stored by process_tex_cached, to be increased whenever scan_equations changes its results
+SCAN_CACHE_VERSION = 2
+
+# Options of the standalone class on every route, so an equation is cropped the same way whether it was compiled
+# on its own, from the format or in a batch, and all of them can share one cache entry
+EQUATION_CLASS_OPTIONS = 'preview,varwidth'
+
+# Document compiled for every equation, filled in by create_equation_file
+EQUATION_TEMPLATE = ('\\documentclass[' + EQUATION_CLASS_OPTIONS + ']{{standalone}}\n'
+                     '{preamble}\\begin{{document}}\n{body}\\end{{document}}\n')
+
+# Matches the start of the supported display environments, \begin{env} (also starred) or \[.
+# The environment name is the only group, it is None for \[.
+EQUATION_START_RE = re.compile(rb'\\begin\{(equation\*?|displaymath|align\*?|multline\*?|gather\*?)\}|\\\[')
+
+# Inner environment that keeps the rows of a multi-row environment valid once its body is typeset on its own
+ROW_ENVIRONMENTS = {
+    b'align': 'aligned', b'align*': 'aligned',
+    b'gather': 'gathered', b'gather*': 'gathered',
+    b'multline': 'gathered', b'multline*': 'gathered',
+}
+
+# Matches a \label{...} or a comment, everything from an unescaped % to the end of the line. For a comment, the run of
+# escaped backslashes before the % is captured, so that it can be kept
+BODY_CLEAN_RE = re.compile(r'\\label\{[^}]*\}|(?<!\\)((?:\\\\)*)%[^\n]*')
+
+# Matches whole \usepackage lines, and the start of \newcommand, \renewcommand, \providecommand (and their * variants),
+# \DeclareMathOperator and \let, so the preamble is scanned only once
+PREAMBLE_DEFINITION_RE = re.compile(r'(?<!^%)\\(usepackage).*?\n|\\(DeclareMathOperator)|\\(?:new|renew|provide)command\*?|\\let',
+                                    re.MULTILINE)
+
+# Matches a definition up to its body: \newcommand{\name}[n][default] (also with * and without braces
+# around the name, and for \renewcommand, \providecommand and \DeclareMathOperator), or a whole \let\name\other.
+# The defined macro is captured in name, bare_name or let_name.
+DEFINITION_HEAD_RE = re.compile(r'\\(?:(?P<command>(?:new|renew|provide)command|DeclareMathOperator)\*?\s*'
+                                r'(?:\{\s*\\(?P<name>[A-Za-z@]+)\s*\}|\\(?P<bare_name>[A-Za-z@]+))\s*'
+                                r'(?:\[\d\]\s*(?:\[[^\]]*\]\s*)?)?(?=\{)'
+                                r'|let\s*\\(?P<let_name>[A-Za-z@]+|.)\s*=?\s*(?:\\[A-Za-z@]+|\\.|[^\\\s]))')
+
+# Matches a macro name, e.g. \alpha, and captures it without the backslash
+MACRO_RE = re.compile(r'\\([A-Za-z@]+)')
+
+# Matches a blank line, possibly several, which TeX reads as \par, an error in math mode
+PARAGRAPH_BREAK_RE = re.compile(r'\n\s*\n')
+
+def read_tex(tex_file):
+    """
+    Reads a LaTeX file once and returns its preamble (everything before \\begin{document}, or None if there is
+    no \\begin{document}) and the bodies of its display equations. Raises OSError or ValueError if it can't be read.
+    """
+    # The file is memory-mapped and scanned as bytes, so only the preamble and the equations are copied and decoded
+    with open(tex_file, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None, []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as tex_content:
+            document_start = tex_content.find(b'\\begin{document}')
+            preamble = tex_content[:document_start].decode('utf-8', errors='replace') if document_start != -1 else None
+            return preamble, scan_equations(tex_content)
+
+
+def process_tex(tex_file):
+    """Like read_tex, but reports a file that can't be read and returns no preamble and no equations for it."""
+    try:
+        return read_tex(tex_file)
+    except (ValueError, OSError) as e:
+        print(f"Error reading {tex_file}: {e}")
+        return None, []  # Skip this file and return an empty list
+
+
+def process_tex_cached(tex_file):
+    """
+    Like process_tex, but reuses the result stored by an earlier run as long as the size and modification time
+    of the file are unchanged, so unchanged documents are not scanned again.
+    The cache is only an optimization: files that can't be read are not cached, and a cache that can't be written
+    is skipped.
+    """
     try:
-        with open(tex_file, 'r', encoding='utf-8', errors='ignore') as file:  # Use 'ignore' to skip invalid characters
-            tex_content = file.read()
-    except (UnicodeDecodeError, IOError) as e:
+        stat = os.stat(tex_file)
+    except OSError:
+        return process_tex(tex_file)
+
+    path_key = hashlib.sha256(os.path.abspath(tex_file).encode('utf-8')).hexdigest()[:16]
+    cache_file = os.path.join(CACHE_DIR, f'scan-{path_key}.json')
+    stamp = [SCAN_CACHE_VERSION, stat.st_size, stat.st_mtime_ns]
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as file:
+            cached = json.load(file)
+        if cached['stamp'] == stamp:
+            return cached['preamble'], cached['equations']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass  # No usable result from an earlier run
+
+    try:
+        preamble, equations = read_tex(tex_file)
+    except (ValueError, OSError) as e:
         print(f"Error reading {tex_file}: {e}")
-        return []  # Skip this file and return an empty list
+        return None, []  # Skip this file, without remembering the failure
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_file, 'w', encoding='utf-8') as file:
+            json.dump({'stamp': stamp, 'preamble': preamble, 'equations': equations}, file)
+    except OSError:
+        pass  # E.g. a read-only folder, the scan result is still used for this run
+    return preamble, equations
 
-    # Extract equations
-    equations = re.findall(r'\\begin{equation}(.*?)\\end{equation}', tex_content, re.DOTALL)
-    equations += re.findall(r'\\\[([\s\S]*?)\\\]', tex_content, re.DOTALL)
-    equations += re.findall(r'\\begin{displaymath}(.*?)\\end{displaymath}', tex_content, re.DOTALL)
-    equations += re.findall(r'\\begin{align}(.*?)\\end{align}', tex_content, re.DOTALL)
-    equations += re.findall(r'\\begin{multline}(.*?)\\begin{multline}', tex_content, re.DOTALL)
+
+def find_equations(tex_file):
+    """Returns the bodies of the display equations of a LaTeX file, or an empty list if it can't be read."""
+    return process_tex(tex_file)[1]
+
+
+def clean_equation_body(body):
+    """
+    Removes labels and comments from an equation body in a single regex pass. Labels mean nothing in the standalone
+    pages, and without them equations that only differ in their label or comments are recognised as repeats.
+    The line breaks are kept, since a removed comment still ends its line.
+    """
+    if '\\label' not in body and '%' not in body:
+        return body
+    return BODY_CLEAN_RE.sub(lambda match: match.group(1) or '', body)
+
+
+def scan_equations(tex_content):
+    """
+    Returns the bodies of the display equations in the bytes-like tex_content, decoded as UTF-8.
+    Bodies of align, gather and multline are wrapped in the matching inner environment from ROW_ENVIRONMENTS,
+    since whether their & and \\ are valid depends on the environment they came from, not on what they contain.
+    """
+    # Extract equations in a single pass, in the order they appear in the document.
+    # The closing marker is looked up with a plain find, so unclosed environments cost one scan
+    # of the rest of the file instead of a regex backtracking over it at every start marker.
+    equations = []
+    exhausted = set()  # Closing markers that no longer appear in the rest of the file
+    pos = 0
+    while True:
+        match = EQUATION_START_RE.search(tex_content, pos)
+        if match is None:
+            break
+        env = match.group(1)
+        end_marker = b'\\end{' + env + b'}' if env else b'\\]'
+        pos = match.end()
+        if end_marker in exhausted:
+            continue
+        end = tex_content.find(end_marker, pos)
+        if end == -1:
+            exhausted.add(end_marker)
+            continue
+        body = clean_equation_body(tex_content[pos:end].decode('utf-8', errors='ignore'))  # Use 'ignore' to skip invalid characters
+        inner = ROW_ENVIRONMENTS.get(env)
+        if inner is not None:
+            body = f'\\begin{{{inner}}}\n{body.strip()}\n\\end{{{inner}}}'
+        equations.append(body)
+        pos = end + len(end_marker)
 
     return equations
 
 def has_balanced_brackets(command):
     return command.count('{') == command.count('}')
 
+def is_escaped(text, index):
+    """Returns True if the character at index is escaped, i.e. preceded by an odd number of backslashes."""
+    backslashes = 0
+    while index - backslashes > 0 and text[index - backslashes - 1] == '\\':
+        backslashes += 1
+    return backslashes % 2 == 1
+
+def find_group_end(text, open_index):
+    """Returns the index just past the brace group opening at open_index, or -1 if the group is never closed."""
+    depth = 0
+    # Jump from brace to brace with str.find, so only the braces themselves are looked at in Python
+    next_open = text.find('{', open_index)
+    next_close = text.find('}', open_index)
+    while next_close != -1:
+        if next_open != -1 and next_open < next_close:
+            if not is_escaped(text, next_open):
+                depth += 1
+            next_open = text.find('{', next_open + 1)
+        else:
+            if not is_escaped(text, next_close):
+                depth -= 1
+                if depth == 0:
+                    return next_close + 1
+            next_close = text.find('}', next_close + 1)
+    return -1
+
 def extract_command_with_content(command_start, preamble):
     """Extracts the full command definition starting from command_start."""
-    start_index = command_start
-    end_index = start_index
-    count_open_brackets = 0
-
-    for i, char in enumerate(preamble[start_index:]):
-        if char == '{':
-            count_open_brackets += 1
-        elif char == '}':
-            count_open_brackets -= 1
-        if count_open_brackets == 0:
-            end_index = start_index + i
-            break
-    else:  # if the loop completes without finding a closing bracket
+    match = DEFINITION_HEAD_RE.match(preamble, command_start)
+    if match is None:
         return None
+    if match.group('command') is None:  # \let has no body group
+        return match.group()
 
-    return preamble[start_index:end_index + 1]
+    end_index = find_group_end(preamble, match.end())
+    if end_index == -1:  # the body is never closed
+        return None
 
-def extract_relevant_commands(preamble):
-    relevant_content = ''
-    
-    # Extracting non-commented \usepackage commands
-    usepackage_matches = [match for match in re.findall(r'(?<!^%)\\usepackage.*?\n', preamble, re.MULTILINE) if not match.strip().startswith('%')]
-    relevant_content += '\n'.join(usepackage_matches) + '\n'
-    
-    # Extracting new/renew/provide command definitions including \newcommand* variant
-    command_definitions_patterns = [
-        r'\\newcommand\*?',
-        r'\\renewcommand\*?',
-        r'\\providecommand\*?',
-        r'\\let'
-    ]
-
-    for pattern in command_definitions_patterns:
-        matches = [m.start() for m in re.finditer(pattern, preamble)]
-        for match_start in matches:
-            full_command = extract_command_with_content(match_start, preamble)
-            if full_command.strip() != '\\':  # Ensure we aren't just adding a standalone backslash
-                relevant_content += full_command + '\n'
-    
-    for pattern in command_definitions_patterns:
-        matches = [m.start() for m in re.finditer(pattern, preamble)]
-        for match_start in matches:
-            full_command = extract_command_with_content(match_start, preamble)
-            if full_command.strip() != '\\':  # Ensure we aren't just adding a standalone backslash
-                relevant_content += full_command + '\n'
-    
-    # Extracting DeclareMathOperator commands
-    math_operator_definitions = [match for match in re.findall(r'(?<!^%)\\DeclareMathOperator.*?\n', preamble, re.MULTILINE) if not match.strip().startswith('%')]
-    relevant_content += '\n'.join(math_operator_definitions) + '\n'
-    
-    return relevant_content.strip()  # Using strip() to remove any leading or trailing newlines
+    return preamble[command_start:end_index]
 
+def macros_in(text):
+    """Returns the names of all macros used in text, without the backslash."""
+    return frozenset(MACRO_RE.findall(text))
 
-def create_equation_file(equation, output_dir, equation_index, relevant_content):
-    equation_content = '\\documentclass[preview,varwidth]{standalone}\n'
-    if relevant_content:
-        equation_content += relevant_content + '\n'
+def needed_definition_names(definitions, needed):
+    """
+    Returns the names of the macros in needed that have one of the (name, definition) pairs, together with
+    every macro their definitions use. All definitions are indexed by name once, so each macro is a dict lookup.
+    """
+    by_name = {}
+    for name, definition in definitions:
+        by_name.setdefault(name, []).append(definition)
+
+    keep = set()
+    pending = [name for name in needed if name in by_name]
+    while pending:
+        name = pending.pop()
+        if name in keep:
+            continue
+        keep.add(name)
+        for definition in by_name[name]:
+            pending.extend(macro for macro in macros_in(definition) if macro in by_name and macro not in keep)
+    return keep
+
+def extract_relevant_commands(preamble, needed=None, extra_packages=None):
+    """
+    Collects the \\usepackage lines, command definitions and \\DeclareMathOperator lines of a preamble.
+    If needed is given, only the definitions of those macros (names without backslash) and their dependencies are kept.
+    extra_packages are \\usepackage lines loaded after the ones of the preamble, but before the definitions.
+    """
+    usepackage_matches = []
+    command_definitions = []
+    math_operator_definitions = []
+
+    # Collect \usepackage lines, new/renew/provide command definitions including the \newcommand* variant,
+    # and \DeclareMathOperator definitions in one pass over the preamble, each group in document order.
+    # Definitions are cut out by matching their braces, so bodies spanning several lines are kept whole.
+    for match in PREAMBLE_DEFINITION_RE.finditer(preamble):
+        if match.group(1):
+            usepackage_matches.append(match.group(0))
+            continue
+        full_command = extract_command_with_content(match.start(), preamble)
+        if full_command and full_command.strip() != '\\':  # Ensure we aren't just adding a standalone backslash
+            head = DEFINITION_HEAD_RE.match(full_command)
+            name = head.group('name') or head.group('bare_name') or head.group('let_name')
+            definitions = math_operator_definitions if match.group(2) else command_definitions
+            definitions.append((name, full_command + '\n'))
 
-    equation_content += '\\begin{document}\n'
+    if needed is not None:
+        # Operators can be used inside commands, so the dependencies are followed across both groups
+        keep = needed_definition_names(command_definitions + math_operator_definitions, needed)
+        command_definitions = [(name, definition) for name, definition in command_definitions if name in keep]
+        math_operator_definitions = [(name, definition) for name, definition in math_operator_definitions if name in keep]
 
+    if extra_packages:
+        usepackage_matches.append(extra_packages.strip())
+
+    relevant_content = ''.join(['\n'.join(usepackage_matches), '\n',
+                                *(definition for _, definition in command_definitions + math_operator_definitions)])
+    return relevant_content.strip()  # Using strip() to remove any leading or trailing newlines
+
+
+@functools.lru_cache(maxsize=4096)
+def equation_block(equation):
+    """
+    Wraps an equation body in the math environment used for the standalone pages.
+    The result is memoized, since the same body is wrapped for its own file, for the batch file and for every repeat.
+    """
     if '\\begin{' not in equation:
-        equation_content += '\\(\n'  # Replace \begin{equation} with \( ...
-        equation_content += equation.strip() + '\n'
-        equation_content += '\\notag\n'
-        equation_content += '\\)\n'  # Replace \end{equation} with \) ...
-    else:
-        equation_content += '\\begin{equation}\n'
-        equation_content += equation.strip() + '\n'
-        equation_content += '\\notag\n'
-        equation_content += '\\end{equation}\n'
+        # Replace \begin{equation} ... \end{equation} with \( ... \)
+        return '\\(\n' + equation.strip() + '\n\\notag\n\\)\n'
+    return '\\begin{equation}\n' + equation.strip() + '\n\\notag\n\\end{equation}\n'
+
 
-    equation_content += '\\end{document}\n'
+def create_equation_file(equation, output_dir, equation_index, relevant_content):
+    preamble = relevant_content + '\n' if relevant_content else ''
+    equation_content = EQUATION_TEMPLATE.format(preamble=preamble, body=equation_block(equation)).encode('utf-8')
 
     equation_file = os.path.abspath(os.path.join(output_dir, f'{equation_index}.tex'))
-    with open(equation_file, 'w') as file:
+    # An unchanged file is not rewritten, so its modification time tells whether the outputs are still current
+    try:
+        with open(equation_file, 'rb') as file:
+            if file.read() == equation_content:
+                return equation_file
+    except OSError:
+        pass
+    with open(equation_file, 'wb') as file:
         file.write(equation_content)
 
     return equation_file
 
 
-def compile_equation(equation_file):
+def is_up_to_date(output_file, equation_file):
+    """Returns True if output_file exists and is not older than the .tex file it is made from."""
+    return os.path.isfile(output_file) and os.path.getmtime(output_file) >= os.path.getmtime(equation_file)
+
+
+def remove_stale_outputs(equation_file):
+    """Removes the PDF and SVG of an equation if they are older than its .tex file, i.e. were made from another equation."""
+    for extension in ('.pdf', '.svg'):
+        output_file = equation_file[:-4] + extension
+        if os.path.isfile(output_file) and not is_up_to_date(output_file, equation_file):
+            os.remove(output_file)
+
+
+def create_batched_equation_file(equations, batch_dir, relevant_content):
+    """Writes all equations into a single standalone document with one page per equation, inside batch_dir."""
+    parts = [f'\\documentclass[{EQUATION_CLASS_OPTIONS},multi=true]{{standalone}}\n']
+    if relevant_content:
+        parts.append(relevant_content + '\n')
+    parts.append('\\begin{document}\n')
+    for equation in equations:
+        parts.append('\\begin{standalone}\n' + equation_block(equation) + '\\end{standalone}\n')
+    parts.append('\\end{document}\n')
+
+    batch_file = os.path.abspath(os.path.join(batch_dir, 'equations.tex'))
+    with open(batch_file, 'w') as file:
+        file.write(''.join(parts))
+
+    return batch_file
+
+
+def build_format(relevant_content):
+    """
+    Dumps the preamble used by create_equation_file into a pdflatex format file, so that compiling an equation
+    loads the class and packages from the frozen format instead of reading them again.
+    The format is kept in the cache folder, named by a hash of the preamble, so it is built once for all documents
+    and runs that share the same preamble.
+    Returns the path of the format without extension, for pdflatex -fmt, or None if it could not be built.
+    """
+    format_name = 'eqfmt-' + equation_key('', relevant_content)[:16]
+    format_file = os.path.abspath(os.path.join(CACHE_DIR, format_name + '.tex'))
+    if os.path.isfile(format_file[:-4] + '.fmt'):
+        return format_file[:-4]
+
+    format_source = f'\\documentclass[{EQUATION_CLASS_OPTIONS}]{{standalone}}\n'
+    if relevant_content:
+        format_source += relevant_content + '\n'
+    # Equation files still start with the full preamble, which is already in the format, so skip everything up to \begin{document}
+    format_source += '\\long\\def\\documentclass#1\\begin#2{\\begin{#2}}\n'
+    format_source += '\\dump\n'
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(format_file, 'w') as file:
+        file.write(format_source)
+
+    timeout = 30  # Timeout in seconds
+    try:
+        result = subprocess.run([find_pdflatex(), '-ini', '-interaction=batchmode', f'-jobname={format_name}', '-output-directory', CACHE_DIR,
+                                 '&pdflatex', format_file],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+        # \dump still runs after errors in batchmode, and a broken format would be reused for every later run
+        error = first_log_error(format_file[:-4] + '.log')
+        failed = result.returncode != 0 or bool(error)
+    except (subprocess.TimeoutExpired, OSError) as e:
+        error = f'Error: {e}'
+        failed = True
+
+    if failed or not os.path.isfile(format_file[:-4] + '.fmt'):
+        if os.path.isfile(format_file[:-4] + '.fmt'):
+            os.remove(format_file[:-4] + '.fmt')
+        print(f'Could not build the pdflatex format, compiling without it. {error}'.rstrip())
+        return None
+    return format_file[:-4]
+
+
+@functools.lru_cache(maxsize=1)
+def find_pdf_splitter():
+    """
+    Returns the command used to split a PDF into one file per page, or None if no splitter is installed.
+    The PDF and the output pattern are appended to the command, except for pdftk, which split_pdf_pages handles.
+    """
+    pdfseparate = shutil.which('pdfseparate')  # poppler-utils
+    if pdfseparate is not None:
+        return [pdfseparate]
+    qpdf = shutil.which('qpdf')
+    if qpdf is not None:
+        return [qpdf, '--split-pages']
+    pdftk = shutil.which('pdftk')
+    if pdftk is not None:
+        return [pdftk]
+    return None
+
+
+def find_page_files(page_prefix):
+    """
+    Returns the <page_prefix><page>.pdf files written by a PDF splitter, in page order.
+    The folder is listed once with os.scandir and the names are matched directly, without glob's pattern handling.
+    """
+    page_dir, name_prefix = os.path.split(page_prefix)
+    pages = []
+    try:
+        with os.scandir(page_dir or '.') as entries:
+            for entry in entries:
+                page = entry.name[len(name_prefix):-4]
+                if entry.name.startswith(name_prefix) and entry.name.endswith('.pdf') and page.isdigit():
+                    pages.append((int(page), entry.path if page_dir else entry.name))
+    except OSError:
+        return []
+    return [page_file for _, page_file in sorted(pages)]
+
+
+def split_pdf_pages(splitter, pdf_file, page_prefix, timeout):
+    """Splits a PDF into <page_prefix><page>.pdf files and returns them in page order."""
+    # All splitters replace %d with the page number, qpdf and pdftk pad it with zeros
+    if os.path.basename(splitter[0]).startswith('pdftk'):
+        # pdftk also writes a doc_data.txt report into its working directory, which is removed afterwards
+        pdf_dir = os.path.dirname(os.path.abspath(pdf_file))
+        subprocess.run(splitter + [os.path.abspath(pdf_file), 'burst', 'output', os.path.abspath(page_prefix) + '%d.pdf'],
+                       cwd=pdf_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+        report_file = os.path.join(pdf_dir, 'doc_data.txt')
+        if os.path.exists(report_file):
+            os.remove(report_file)
+    else:
+        subprocess.run(splitter + [pdf_file, page_prefix + '%d.pdf'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+    return find_page_files(page_prefix)
+
+
+def compile_equations_batched(equations, indices, output_dir, relevant_content):
+    """
+    Compiles several equations with a single pdflatex run and splits the result into
+    one <index>.pdf per equation with pdfseparate, qpdf or pdftk, so pdflatex starts once instead of once per equation.
+    Returns False if the batch could not be used, in which case the equations have to be compiled one by one.
+    A batch with any TeX error is discarded as a whole, since batchmode still ships a page for a broken equation,
+    and the per-file compiles then report which equation failed.
+    The batch is compiled in a temporary folder inside output_dir, so its files can't overwrite a source or an
+    equation in the output folder, and everything pdflatex writes for it is removed afterwards.
+    """
+    splitter = find_pdf_splitter()
+    if splitter is None or len(equations) < 2:
+        return False
+
+    try:
+        batch_dir = tempfile.mkdtemp(prefix='tex2svg-batch-', dir=output_dir)
+    except OSError as e:
+        print(f'Batched compilation failed, compiling the equations one by one. Error: {e}')
+        return False
+    try:
+        return compile_batch(equations, indices, output_dir, batch_dir, relevant_content, splitter)
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+
+def compile_batch(equations, indices, output_dir, batch_dir, relevant_content, splitter):
+    """Does the work of compile_equations_batched in batch_dir, moving only the finished pages to output_dir."""
+    batch_file = create_batched_equation_file(equations, batch_dir, relevant_content)
+    batch_pdf = batch_file[:-4] + '.pdf'
+    page_prefix = os.path.join(batch_dir, 'equations-page-')
+    page_files = []
+    failed = False
+
+    timeout = 10 * len(equations)  # Same budget as compiling the equations one by one
+    try:
+        result = subprocess.run([find_pdflatex(), '-interaction=batchmode', '-output-directory', batch_dir, batch_file],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+        error = first_log_error(batch_file[:-4] + '.log')
+        if result.returncode != 0 or error:
+            print(f'Batched compilation failed, compiling the equations one by one. {error}'.rstrip())
+            failed = True
+        elif os.path.isfile(batch_pdf):
+            page_files = split_pdf_pages(splitter, batch_pdf, page_prefix, timeout)
+    except (subprocess.TimeoutExpired, OSError) as e:
+        print(f'Batched compilation failed, compiling the equations one by one. Error: {e}')
+        failed = True
+
+    # Every equation must have produced exactly one page, otherwise the pages can't be matched to equations
+    produced = not failed and len(page_files) == len(equations)
+    if produced:
+        for index, page_file in zip(indices, page_files):
+            os.replace(page_file, os.path.join(output_dir, f'{index}.pdf'))
+        print(f'Compiled {len(equations)} equations with a single pdflatex run.')
+    elif not failed:
+        print('Batched compilation did not produce one page per equation, compiling the equations one by one.')
+    return produced
+
+
+@functools.lru_cache(maxsize=1)
+def find_pdflatex():
+    """Returns the path of pdflatex on the PATH, looked up once so every compile doesn't search the PATH again."""
+    return shutil.which('pdflatex') or 'pdflatex'
+
+
+@functools.lru_cache(maxsize=1)
+def pdflatex_version():
+    """Returns the first line of `pdflatex --version`, or an empty string if pdflatex can't be run."""
+    try:
+        result = subprocess.run([find_pdflatex(), '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=10)
+        return result.stdout.split('\n', 1)[0]
+    except (OSError, subprocess.TimeoutExpired):
+        return ''
+
+
+def equation_key(equation, relevant_content):
+    """
+    Returns a hash of everything create_equation_file puts into the .tex file of an equation,
+    together with the pdflatex version, so results are never shared between different TeX installations.
+    The body is normalized first, so the key also matches repeats of an equation that are written differently.
+    """
+    # Runs of whitespace don't change how math is typeset, so equations that only differ in spacing or line breaks
+    # share one key. With a % the line break ends a comment, so such bodies are kept as they are.
+    # Blank lines inside the body are kept apart, since they make the equation fail instead of only adding space;
+    # the ones around it are stripped from the .tex file as well.
+    if '%' in equation:
+        body = equation.strip()
+    else:
+        body = '\n\n'.join(' '.join(paragraph.split()) for paragraph in PARAGRAPH_BREAK_RE.split(equation.strip()))
+    key_content = f'{pdflatex_version()}\0{relevant_content}\0{body}'
+    return hashlib.sha256(key_content.encode('utf-8')).hexdigest()
+
+
+def copy_if_missing(source_file, target_file):
+    """Copies source_file to target_file unless the target already exists. Returns True if a copy was made."""
+    if os.path.isfile(source_file) and not os.path.exists(target_file):
+        shutil.copyfile(source_file, target_file)
+        return True
+    return False
+
+
+def restore_from_cache(key, output_dir, equation_index):
+    """Copies the cached PDF and SVG of an equation, if any, into the output directory."""
+    for extension in ('.pdf', '.svg'):
+        target_file = os.path.join(output_dir, f'{equation_index}{extension}')
+        if copy_if_missing(os.path.join(CACHE_DIR, key + extension), target_file):
+            print(f'Restored {target_file} from the cache.')
+
+
+def store_in_cache(key, output_dir, equation_index, extension):
+    """
+    Stores the output file of an equation in the cache, if it was produced from the current .tex file.
+    Callers only pass equations whose output came from a successful run, the cache is never cleaned up.
+    """
+    output_file = os.path.join(output_dir, f'{equation_index}{extension}')
+    equation_file = os.path.join(output_dir, f'{equation_index}.tex')
+    # Outputs older than the .tex file are left over from a previous run and may belong to a different equation
+    if is_up_to_date(output_file, equation_file):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        copy_if_missing(output_file, os.path.join(CACHE_DIR, key + extension))
+
+
+def copy_equation_output(output_dir, source_index, target_index, extension):
+    """Copies the output file of one equation to another equation index, e.g. 3.pdf to 7.pdf."""
+    source_file = os.path.join(output_dir, f'{source_index}{extension}')
+    target_file = os.path.join(output_dir, f'{target_index}{extension}')
+    if copy_if_missing(source_file, target_file):
+        print(f'Equation {target_index} is identical to equation {source_index}. Copied {source_file} to {target_file}.')
+
+
+def first_log_error(log_file):
+    """Returns the first error message from a pdflatex log file, or an empty string if there is none."""
+    try:
+        with open(log_file, 'r', encoding='utf-8', errors='replace') as file:
+            for line in file:
+                if line.startswith('!'):
+                    return line.strip()
+    except OSError:
+        pass
+    return ''
+
+
+def compile_equation(equation_file, format_file=None):
+    """Compiles an equation file to PDF. Returns True only if pdflatex ran and succeeded in this call."""
     equation_basename = os.path.splitext(os.path.basename(equation_file))[0]
     output_dir = os.path.dirname(equation_file)
     pdf_file = os.path.join(output_dir, f'{equation_basename}.pdf')
 
-    if os.path.isfile(pdf_file):
+    if is_up_to_date(pdf_file, equation_file):
         print(f'Skipping compilation for equation {equation_basename}.pdf. PDF file already exists.')
-        return equation_basename
+        return False
 
-    process = None
+    timeout = 10  # Timeout in seconds
+    try:
+        # batchmode keeps pdflatex from waiting on stdin when an equation has an error and from writing to the terminal
+        format_args = [f'-fmt={format_file}'] if format_file else []
+        result = subprocess.run([find_pdflatex(), *format_args, '-interaction=batchmode', '-output-directory', output_dir, equation_file],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+        if result.returncode == 0:
+            print(f'Equation {equation_basename} compiled successfully.')
+            return True
+        else:
+            # Only a failed run reads the log, the output of pdflatex is never captured
+            print(f'Equation {equation_basename} failed! {first_log_error(pdf_file[:-4] + ".log")}'.rstrip())
+    except subprocess.TimeoutExpired:
+        print(f'Equation {equation_basename} failed! pdflatex timed out after {timeout} seconds.')
+    except OSError as e:
+        print(f'Equation {equation_basename} failed! Error: {e}')
 
-    def run_pdflatex():
-        nonlocal process
-        process = subprocess.Popen(['pdflatex', '-output-directory', output_dir, equation_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        _, _ = process.communicate()
+    return False
 
-    timeout = 10  # Timeout in seconds
-    timer = threading.Timer(timeout, lambda: process.kill() if process is not None else None)
+
+@functools.lru_cache(maxsize=1)
+def find_dvisvgm():
+    """Returns True if latex and dvisvgm are both available, so equations can be turned into SVG without Inkscape."""
+    return shutil.which('latex') is not None and shutil.which('dvisvgm') is not None
+
+
+def compile_equation_dvisvgm(equation_file):
+    """
+    Compiles an equation to DVI with latex and converts it straight to SVG with dvisvgm, skipping the PDF and Inkscape steps.
+    Returns True if the SVG was created and both latex and dvisvgm succeeded. Equations that fail here,
+    e.g. because they need a PDF-only package, are left to the pdflatex and Inkscape pipeline.
+    """
+    equation_basename = os.path.splitext(os.path.basename(equation_file))[0]
+    output_dir = os.path.dirname(equation_file)
+    dvi_file = os.path.join(output_dir, f'{equation_basename}.dvi')
+    svg_file = os.path.join(output_dir, f'{equation_basename}.svg')
+
+    if os.path.isfile(svg_file):
+        return True
+
+    timeout = 10  # Timeout in seconds, per process
     try:
-        timer.start()
-        run_pdflatex()
-        print(f'Equation {equation_basename} compiled successfully.')
-    except:
-        print(f'Equation {equation_basename} failed!')
+        # In batchmode latex still writes a DVI for an equation with errors, so only the exit status can be trusted
+        result = subprocess.run(['latex', '-interaction=batchmode', '-output-directory', output_dir, equation_file],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+        if result.returncode != 0 or not os.path.isfile(dvi_file):
+            return False
+        # --no-fonts draws the glyphs as paths, like the SVGs exported by Inkscape, and -e crops to the exact bounding box
+        result = subprocess.run(['dvisvgm', '--no-fonts', '-e', '-o', svg_file, dvi_file],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+    except (subprocess.TimeoutExpired, OSError):
+        result = None
     finally:
-        timer.cancel()
-        if process is not None:
-            
-            process.kill()
+        if os.path.isfile(dvi_file):
+            os.remove(dvi_file)
 
+    if result is None or result.returncode != 0:
+        # A partial SVG would keep the equation from being compiled with pdflatex
+        if os.path.isfile(svg_file):
+            os.remove(svg_file)
+        return False
+    if os.path.isfile(svg_file):
+        print(f'Equation {equation_basename} converted to SVG with dvisvgm.')
+        return True
+    return False
+
+
+def compile_and_convert(equation_file, format_file, pdf_converter):
+    """
+    Compiles an equation to PDF and, if a lightweight converter is available, converts it to SVG right away,
+    so the SVG conversion of one equation overlaps with the compilation of the others.
+    Returns True if the equation was compiled successfully in this call, like compile_equation.
+    """
+    compiled = compile_equation(equation_file, format_file)
+    pdf_file = equation_file[:-4] + '.pdf'
+    if pdf_converter is not None and os.path.isfile(pdf_file):
+        convert_pdf_to_svg_cli(pdf_file, pdf_file[:-4] + '.svg', pdf_converter)
+    return compiled
+
+
+@functools.lru_cache(maxsize=1)
+def find_svg_optimizer():
+    """
+    Returns the path of an SVG optimizer on the PATH, svgo or scour, or None to keep the SVGs as they are converted.
+    The full path is needed to start npm's svgo.cmd wrapper on Windows.
+    """
+    for optimizer in ('svgo', 'scour'):
+        optimizer_path = shutil.which(optimizer)
+        if optimizer_path is not None:
+            print(f'Using {optimizer} to optimize the SVG files.')
+            return optimizer_path
+    return None
+
+
+# svgo configuration that keeps the viewBox, which preset-default of svgo 3 and older removes, so the SVGs still scale
+SVGO_CONFIG = """module.exports = {
+  multipass: true,
+  plugins: [{ name: 'preset-default', params: { overrides: { removeViewBox: false } } }],
+};
+"""
+
+
+def svgo_config_file():
+    """Writes SVGO_CONFIG into the cache folder, if it isn't there yet, and returns its path, or None if it can't be written."""
+    config_file = os.path.abspath(os.path.join(CACHE_DIR, 'svgo.config.cjs'))
+    try:
+        with open(config_file, 'r', encoding='utf-8') as file:
+            if file.read() == SVGO_CONFIG:
+                return config_file
+    except OSError:
+        pass
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(config_file, 'w', encoding='utf-8') as file:
+            file.write(SVGO_CONFIG)
+    except OSError:
+        return None
+    return config_file
+
+
+def optimize_svgs(svg_files, optimizer):
+    """
+    Shrinks freshly converted SVGs in place, dropping the redundant transforms and default attributes Inkscape writes.
+    svgo takes up to 200 files per call, so Node starts once per group instead of once per file;
+    scour runs once per file, side by side.
+    """
+    svg_files = list(svg_files)
+    if not svg_files:
+        return
+
+    if os.path.basename(optimizer).lower().startswith('svgo'):
+        config_file = svgo_config_file()
+        if config_file is None:
+            print('Could not write the svgo configuration, the SVG files are not optimized.')
+            return
+        # The files are passed in groups, to stay below the command line length limit on Windows
+        group_size = 200
+        for start in range(0, len(svg_files), group_size):
+            group = svg_files[start:start + group_size]
+            timeout = 30 + len(group)  # Startup plus a generous budget per file
+            try:
+                # Without an output, svgo overwrites each input file
+                subprocess.run([optimizer, '--config', config_file, '--quiet', *group],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+            except (subprocess.TimeoutExpired, OSError) as e:
+                print(f'Failed to optimize the SVG files with svgo. Error: {e}')
+        return
+
+    timeout = 30  # Timeout in seconds, per file
+
+    def scour(svg_file):
+        optimized_file = svg_file[:-4] + '.scour.svg'
+        try:
+            result = subprocess.run([optimizer, '-i', svg_file, '-o', optimized_file, '--enable-id-stripping', '--shorten-ids'],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+            completed = result.returncode == 0
+        except (subprocess.TimeoutExpired, OSError):
+            completed = False
+        # scour creates its output before parsing the input, so the original is only replaced after a successful run
+        if completed and os.path.isfile(optimized_file):
+            os.replace(optimized_file, svg_file)
+        elif os.path.isfile(optimized_file):
+            os.remove(optimized_file)
+
+    run_parallel(scour, svg_files)
+
+
+def usable_cpu_count():
+    """Returns the number of CPUs this process may run on, which can be fewer than os.cpu_count() in containers."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+def run_parallel(function, *iterables):
+    """
+    Calls function for every set of arguments taken from iterables, like map, and returns the results in order.
+    The calls run in a thread pool, which is enough because the real work happens in external processes.
+    """
+    arguments = list(zip(*iterables))
+    if not arguments:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(arguments), usable_cpu_count())) as executor:
+        return list(executor.map(lambda args: function(*args), arguments))
+
+
+@functools.lru_cache(maxsize=1)
+def find_inkscape():
+    """Returns the path of the Inkscape executable, preferring the one on the system PATH."""
+    inkscape_path = shutil.which('inkscape')
+    if inkscape_path is not None:
+        print(f'Inkscape executable is available in the system PATH: {inkscape_path}.')
+        return inkscape_path
+
+    inkscape_path = r'C:\Program Files\Inkscape\bin\inkscape.exe'  # Fallback to absolute path if 'inkscape' command is not found
+    print(f'The "inkscape" command is not available in the system path. Fallback to absolute path {inkscape_path}.')
+    if not os.path.exists(inkscape_path):
+        print(f'Inkscape executable not found at the specified path {inkscape_path}.')
+    return inkscape_path
+
+
+@functools.lru_cache(maxsize=1)
+def find_pdf_converter():
+    """
+    Returns the name of a lightweight PDF to SVG converter on the PATH, pdftocairo, mutool or pdf2svg,
+    or None to use Inkscape.
+    """
+    for converter in ('pdftocairo', 'mutool', 'pdf2svg'):
+        if shutil.which(converter) is not None:
+            print(f'Using {converter} to convert PDFs to SVG.')
+            return converter
+    return None
+
+
+def convert_pdf_to_svg_cli(pdf_file, svg_file, converter):
+    """
+    Converts a single page PDF to SVG with pdftocairo, mutool or pdf2svg, which start much faster than Inkscape.
+    Returns True if the SVG was created, otherwise the file is left to Inkscape.
+    A failed or timed out converter can leave a partial SVG behind, which is removed so Inkscape still converts the PDF.
+    """
+    if os.path.exists(svg_file):
+        return True
+
+    # mutool numbers the pages of SVG output through %d in the output name, so it writes to a page file first
+    page_file = svg_file[:-4] + '.page1.svg'
+    if converter == 'mutool':
+        if '%' in svg_file:
+            return False
+        command = ['mutool', 'convert', '-o', svg_file[:-4] + '.page%d.svg', pdf_file]
+    elif converter == 'pdftocairo':
+        command = ['pdftocairo', '-svg', pdf_file, svg_file]
+    else:
+        command = ['pdf2svg', pdf_file, svg_file]
+    timeout = 10  # Timeout in seconds
+    try:
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+    except (subprocess.TimeoutExpired, OSError):
+        result = None
+
+    if result is None or result.returncode != 0:
+        for partial_file in (svg_file, page_file) if converter == 'mutool' else (svg_file,):
+            if os.path.isfile(partial_file):
+                os.remove(partial_file)
+        return False
+    if converter == 'mutool' and os.path.exists(page_file):
+        os.replace(page_file, svg_file)
+    if os.path.exists(svg_file):
+        print(f"Successfully converted {pdf_file} to SVG.")
+        return True
+    return False
 
-    
-    return equation_basename
 
 def convert_pdf_to_svg(pdf_file, svg_file, inkscape_path):
     if os.path.exists(svg_file):
         print(f"SVG file {svg_file} already exists. Skipping conversion.")
         return
     
+    timeout = 60  # Timeout in seconds, Inkscape can take a while to start
     try:
-        subprocess.run([inkscape_path, '--pdf-poppler', '--export-type=svg', '--export-filename=' + svg_file, pdf_file], check=True)
+        subprocess.run([inkscape_path, '--pdf-poppler', '--export-type=svg', '--export-filename=' + svg_file, pdf_file],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, timeout=timeout)
         print(f"Successfully converted {pdf_file} to SVG.")
+    except subprocess.TimeoutExpired:
+        print(f"Failed to convert {pdf_file} to SVG. Inkscape timed out after {timeout} seconds.")
     except subprocess.CalledProcessError as e:
         print(f"Failed to convert {pdf_file} to SVG. Error: {e}")
     except FileNotFoundError:
         print(f"Inkscape executable not found at path {inkscape_path}. Please provide the correct path .")
 
 
+def run_inkscape_shell(shell_pairs, inkscape_path):
+    """Converts the given (pdf, svg) pairs in one `inkscape --shell` session."""
+    commands = ''.join(f'file-open:{os.path.abspath(pdf_file)}; export-filename:{os.path.abspath(svg_file)}; export-do; file-close\n'
+                       for pdf_file, svg_file in shell_pairs) + 'quit\n'
+    timeout = 30 + 10 * len(shell_pairs)  # Startup plus a generous budget per file
+    try:
+        subprocess.run([inkscape_path, '--pdf-poppler', '--shell'], input=commands, text=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        print(f"Inkscape shell timed out after {timeout} seconds.")
+    except OSError as e:
+        print(f"Failed to start the Inkscape shell. Error: {e}")
+
+
+def convert_pdfs_to_svg_shell(pdf_files, svg_files, inkscape_path):
+    """
+    Converts many PDFs to SVG with `inkscape --shell` sessions, so Inkscape starts a few times instead of once per file.
+    Large batches are spread over up to 4 sessions running in parallel, each with at least 10 files to make up for its startup.
+    Returns the (pdf, svg) pairs that still have no SVG afterwards, e.g. with an Inkscape version without shell actions.
+    """
+    pairs = [(pdf_file, svg_file) for pdf_file, svg_file in zip(pdf_files, svg_files) if not os.path.exists(svg_file)]
+    # Shell actions are separated by ';', so paths containing it are left to the per-file conversion
+    shell_pairs = [(pdf_file, svg_file) for pdf_file, svg_file in pairs if ';' not in pdf_file + svg_file]
+    if not shell_pairs:
+        return pairs
+
+    sessions = max(1, min(4, usable_cpu_count(), len(shell_pairs) // 10))
+    run_parallel(run_inkscape_shell, [shell_pairs[i::sessions] for i in range(sessions)], [inkscape_path] * sessions)
+
+    for pdf_file, svg_file in shell_pairs:
+        if os.path.exists(svg_file):
+            print(f"Successfully converted {pdf_file} to SVG.")
+    return [(pdf_file, svg_file) for pdf_file, svg_file in pairs if not os.path.exists(svg_file)]
+
+
 if __name__ == "__main__":
     # Get the input arguments from the console
-    tex_file = sys.argv[1] if len(sys.argv) > 1 else None
-    output_folder = sys.argv[2] if len(sys.argv) > 2 else None
+    # --preamble also copies the \usepackage lines and the definitions the equations use from the preamble of the document
+    arguments = [argument for argument in sys.argv[1:] if argument != '--preamble']
+    use_preamble = len(arguments) < len(sys.argv) - 1
+    tex_file = arguments[0] if len(arguments) > 0 else None
+    output_folder = arguments[1] if len(arguments) > 1 else None
 
     # Find all .tex files in the current folder if the input file is not provided
     if tex_file is None:
-        tex_files = glob.glob('*.tex')
+        # A single directory listing, with the same hidden file rule as glob
+        tex_files = sorted(entry.name for entry in os.scandir('.')
+                           if entry.name.endswith('.tex') and not entry.name.startswith('.') and entry.is_file())
 
     else:
         tex_files = [tex_file]
 
+    # Look up Inkscape and dvisvgm once for all input files
+    inkscape_path = find_inkscape()
+    inkscape_ok = os.path.exists(inkscape_path)
+    use_dvisvgm = find_dvisvgm()
+    pdf_converter = find_pdf_converter()
+    svg_optimizer = find_svg_optimizer()
+
     # Iterate over each .tex file
     print(f"Processing input files: {tex_files}")
     for tex_file in tex_files:
         print(f"Processing input file: {tex_file}")
 
-        equations = find_equations(tex_file)
-
-        # Read the original tex file to find newcommand lines
-
-        if 0:
-            try:
-                with open(tex_file, 'r', encoding='utf-8', errors='replace') as file:
-                    tex_content = file.read()
-
-                # Extract the preamble (everything before \begin{document})
-                preamble_match = re.search(r'^(.*?)\\begin{document}', tex_content, re.DOTALL | re.MULTILINE)
-                if preamble_match:
-                    preamble = preamble_match.group(1)  # Get everything before \begin{document}
-                    relevant_content = extract_relevant_commands(preamble)
-                else:
-                    print(f"Preamble not found in {tex_file}")
-                    relevant_content = None
-            except Exception as e:
-                print(f"Error reading {tex_file}: {e}")
-                newcommands, relevant_content = [], None  # Default in case of error
+        # The preamble (everything before \begin{document}) comes from the same read as the equations
+        preamble, equations = process_tex_cached(tex_file)
 
         # Add the required \usepackage command to the relevant_content
         relevant_content = '\n\\usepackage{amsmath,amssymb,amsfonts,mathtools,amsthm}'
 
+        # Use the preamble of the original tex file to find newcommand lines
+        if use_preamble:
+            if preamble is not None:
+                # The document's own packages come first, so options it passes to amsmath and the others don't clash,
+                # and its definitions last, so those using \DeclareMathOperator or other amsmath commands work
+                relevant_content = '\n' + extract_relevant_commands(preamble, macros_in(''.join(equations)), relevant_content)
+            else:
+                print(f"Preamble not found in {tex_file}")
+
 
         # Create the output directory
         if output_folder is None:
@@ -208,45 +944,81 @@ if __name__ == "__main__":
 
         print(f"Output directory: {output_dir}")
 
-        # Save each equation in a separate .tex file and compile to PDF
+        # Save each equation in a separate .tex file
+        equation_files = [create_equation_file(equation, output_dir, i, relevant_content) for i, equation in enumerate(equations)]
+        for equation_file in equation_files:
+            remove_stale_outputs(equation_file)
+
+        # Identical equations are compiled only once, the duplicates get a copy of the result
+        first_index = {}
+        duplicates = {}  # Index of a duplicate equation -> index of the first identical equation
         for i, equation in enumerate(equations):
-            equation_file = create_equation_file(equation, output_dir, i, relevant_content)
-            equation_basename = compile_equation(equation_file)
+            key = equation_key(equation, relevant_content)
+            if key in first_index:
+                duplicates[i] = first_index[key]
+            else:
+                first_index[key] = i
 
-            # Set file permissions for the PDF file
-            pdf_file = os.path.join(output_dir, f'{equation_basename}.pdf')
+        # Equations compiled before, in this or an earlier run, are restored from the cache
+        keys = {i: key for key, i in first_index.items()}
+        for i, key in keys.items():
+            restore_from_cache(key, output_dir, i)
+        # Only outputs of successful runs go into the cache, a failed run can still leave a partial PDF or SVG behind.
+        # An SVG is trusted if its PDF is, or if dvisvgm made it in this run.
+        trusted = {i for i, key in keys.items() if os.path.isfile(os.path.join(CACHE_DIR, key + '.pdf'))}
 
-        try:
-            os.chmod(pdf_file, 0o755)  # Set read, write, and execute permissions
-        except FileNotFoundError as fnf_error:
-            print(f"File not found: {pdf_file}")
-        except Exception as e:
-            print(f"Error changing file permissions for {pdf_file}: {e}")
+        # With dvisvgm, equations go straight from DVI to SVG and only the ones it can't handle take the PDF route
+        unique_indices = sorted(keys)
+        existing_svgs = {i for i in unique_indices if os.path.isfile(os.path.join(output_dir, f'{i}.svg'))}
+        dvisvgm_svgs = set()
+        if use_dvisvgm:
+            dvisvgm_indices = [i for i in unique_indices if i not in existing_svgs]
+            results = run_parallel(compile_equation_dvisvgm, [equation_files[i] for i in dvisvgm_indices])
+            dvisvgm_svgs = {i for i, converted in zip(dvisvgm_indices, results) if converted}
+        needs_pdf = [i for i in unique_indices if not os.path.isfile(os.path.join(output_dir, f'{i}.svg'))]
 
-        try:
-            subprocess.run(['inkscape', '--version'], check=True)
-            inkscape_path = 'inkscape'  # Use 'inkscape' command if available in the system path
-            print('Inkscape executable is available in the system PATH.')
-        except FileNotFoundError:
-            inkscape_path = r'C:\Program Files\Inkscape\bin\inkscape.exe'  # Fallback to absolute path if 'inkscape' command is not found
-            print(f'The "inkscape" command is not available in the system path. Fallback to absolute path {inkscape_path}.')
-
-        if os.path.exists(inkscape_path):
-            print('Inkscape executable found.')
-        else:
-            print('Inkscape executable not found at the specified path {inkscape_path}.')
+        # Try to compile all equations that don't have a PDF yet with a single pdflatex run
+        pending = [i for i in needs_pdf if not os.path.isfile(os.path.join(output_dir, f'{i}.pdf'))]
+        if compile_equations_batched([equations[i] for i in pending], pending, output_dir, relevant_content):
+            trusted.update(pending)
 
-        try:
-            subprocess.run([inkscape_path, '--version'], check=True)
-            print("Inkscape executable is working.")
-        except subprocess.CalledProcessError as e:
-            print("Failed to run Inkscape. Error:", e)
-        except FileNotFoundError:
-            print("Inkscape executable not found. Please provide the correct path.")
-
-        for file_name in os.listdir(output_dir):
-            if file_name.endswith('.pdf'):
-                pdf_file = os.path.join(output_dir, file_name)
-                svg_file = os.path.join(output_dir, file_name[:-4] + '.svg')
-                convert_pdf_to_svg(pdf_file, svg_file, inkscape_path)
-                print(f"Output SVG file: {svg_file}")
+        # Compile the remaining unique equations to PDF in parallel, from a dumped format when it pays off.
+        # With mutool or pdf2svg, each worker converts its PDF to SVG as soon as it is compiled.
+        format_file = None
+        if sum(not os.path.isfile(os.path.join(output_dir, f'{i}.pdf')) for i in needs_pdf) > 1:
+            format_file = build_format(relevant_content)
+        results = run_parallel(compile_and_convert, [equation_files[i] for i in needs_pdf],
+                               itertools.repeat(format_file), itertools.repeat(pdf_converter))
+        trusted.update(i for i, compiled in zip(needs_pdf, results) if compiled)
+        for i in trusted:
+            store_in_cache(keys[i], output_dir, i, '.pdf')
+
+        for i, source_index in duplicates.items():
+            copy_equation_output(output_dir, source_index, i, '.pdf')
+
+        pdf_files = [os.path.join(output_dir, f'{i}.pdf') for i in needs_pdf]
+        pdf_files = [pdf_file for pdf_file in pdf_files if os.path.isfile(pdf_file)]
+        pdf_svg_files = [pdf_file[:-4] + '.svg' for pdf_file in pdf_files]
+        svg_files = [os.path.join(output_dir, f'{i}.svg') for i in unique_indices]
+
+        # Convert everything left in one Inkscape session, then fall back to one Inkscape call per remaining file.
+        # Each of these calls is an independent process, so they run side by side.
+        # Inkscape is only started if it was found, instead of failing once per file
+        remaining = convert_pdfs_to_svg_shell(pdf_files, pdf_svg_files, inkscape_path) if inkscape_ok else []
+        if remaining:
+            remaining_pdfs, remaining_svgs = zip(*remaining)
+            run_parallel(convert_pdf_to_svg, remaining_pdfs, remaining_svgs, itertools.repeat(inkscape_path))
+
+        # Optimize the SVGs converted in this run, before they are cached and copied to repeated equations
+        if svg_optimizer is not None:
+            optimize_svgs([svg_file for i, svg_file in zip(unique_indices, svg_files)
+                           if i not in existing_svgs and os.path.isfile(svg_file)], svg_optimizer)
+        for i in trusted | dvisvgm_svgs:
+            store_in_cache(keys[i], output_dir, i, '.svg')
+
+        for i, source_index in duplicates.items():
+            copy_equation_output(output_dir, source_index, i, '.svg')
+            svg_files.append(os.path.join(output_dir, f'{i}.svg'))
+
+        for svg_file in svg_files:
+            print(f"Output SVG file: {svg_file}")